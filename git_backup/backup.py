@@ -2,7 +2,7 @@ import itertools
 import logging
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Union
+from typing import Dict, Optional, Union
 
 import pygit2
 
@@ -13,23 +13,37 @@ logger = logging.getLogger(__name__)
 
 
 class LocalBackup:
-    '''Backup a single remote git repo to a clone on the local filesystem.'''
+    '''Backup a single remote git repo to a clone on the local filesystem.
+
+    shallow_depth -- If set, the initial clone has only this many commits
+    from the tip of each reference. Later fetches download all the new
+    commits, so the reference update logic is the same as for a full clone.
+    Repos at a local path are always cloned in full.
+    '''
 
     def __init__(self, repo: GitRepo,
                  base_dir: Union[str, Path],
-                 callbacks: pygit2.RemoteCallbacks = None):
+                 callbacks: Optional[pygit2.RemoteCallbacks] = None,
+                 shallow_depth: Optional[int] = None):
         self.dest_path = Path(base_dir) / (repo.full_name + ".git")
-        assert '..' not in str(self.dest_path), \
-            "Dest path {!r} contains '..'".format(self.dest_path)
+        self.dest_path_str = str(self.dest_path)
+        assert '..' not in self.dest_path.parts, \
+            "Dest path {!r} contains '..'".format(self.dest_path_str)
 
         self.source_repo = repo
         self.callbacks = callbacks
+        self.shallow_depth = shallow_depth
 
         self.fetch_ref_prefix = 'refs/git-backup/origin/'
         self.fetch_prefix_filters = [
             'heads/',
             'tags/',
         ]
+        self.expected_refspecs = [f'+refs/{pf}*:{self.fetch_ref_prefix}{pf}*'
+                                  for pf in self.fetch_prefix_filters]
+        self._config_done = False
+        self._refs_cache: Optional[Dict[str, pygit2.Reference]] = None  # See `_refs`
+        self._backup_timestr = ''  # Refreshed at `update_refs`
 
         self.cloned_repo: pygit2.Repository  # Initialize at `clone`
 
@@ -40,6 +54,8 @@ class LocalBackup:
         repository.
         '''
 
+        self._config_done = False
+        self._refs_cache = None
         if self.dest_path.exists():
             self._existing_clone()
         else:
@@ -47,37 +63,51 @@ class LocalBackup:
 
     def _new_clone(self):
         logger.debug('New clone of repo %r at %r', self.source_repo.full_name,
-                     str(self.dest_path))
-        self.cloned_repo = pygit2.clone_repository(self.source_repo.url,
-                                                   str(self.dest_path),
+                     self.dest_path_str)
+        url = self.source_repo.url
+        depth_kwargs = {}
+        if self.shallow_depth is not None:
+            if url.startswith('file://') or Path(url).exists():
+                logger.info("Full clone of %r: the local transport cannot "
+                            "clone shallow", self.source_repo.full_name)
+            else:
+                depth_kwargs['depth'] = self.shallow_depth
+        # libgit2 already copies objects directly (GIT_CLONE_LOCAL_AUTO)
+        # when the URL is a local path, without pack negotiation
+        self.cloned_repo = pygit2.clone_repository(url,
+                                                   self.dest_path_str,
                                                    bare=True,
-                                                   callbacks=self.callbacks)
+                                                   callbacks=self.callbacks,
+                                                   **depth_kwargs)
 
     def _existing_clone(self):
         logger.debug("Repo %r is already cloned at %r",
-                     self.source_repo.full_name, str(self.dest_path))
-        self.cloned_repo = pygit2.Repository(str(self.dest_path))
+                     self.source_repo.full_name, self.dest_path_str)
+        self.cloned_repo = pygit2.Repository(self.dest_path_str)
 
-        if not any(r.name == 'origin' for r in self.cloned_repo.remotes):
+        try:
+            origin = self.cloned_repo.remotes['origin']
+        except KeyError:
             raise RuntimeError('Repo at {!r} does not have an \'origin\' remote'
-                               .format(str(self.dest_path)))
-        elif self.cloned_repo.remotes['origin'].url != self.source_repo.url:
+                               .format(self.dest_path_str)) from None
+        if origin.url != self.source_repo.url:
             raise RuntimeError('\'origin\' remote at {!r} has URL {!r} instead of {!r}'
-                               .format(str(self.dest_path),
-                                       self.cloned_repo.remotes['origin'].url,
+                               .format(self.dest_path_str, origin.url,
                                        self.source_repo.url))
 
     def _config_local_clone(self):
         '''Edit the local clone's configuration to fetch the correct references.
 
-        This method is idempotent.
+        This method is idempotent, and does nothing after the first call.
         '''
 
+        if self._config_done:
+            return
+
         config = self.cloned_repo.config
         fetch_lines = config.get_multivar('remote.origin.fetch')
-        expected_refspecs = [f'+refs/{pf}*:{self.fetch_ref_prefix}{pf}*'
-                             for pf in self.fetch_prefix_filters]
-        if sorted(fetch_lines) != sorted(expected_refspecs):
+        expected_refspecs = self.expected_refspecs
+        if set(fetch_lines) != set(expected_refspecs):
             # Match all and replace with first refspec
             config.set_multivar('remote.origin.fetch', '',
                                 expected_refspecs[0])
@@ -87,47 +117,114 @@ class LocalBackup:
 
         self.cloned_repo.config['remote.origin.prune'] = False
         self.cloned_repo.config['remote.origin.tagOpt'] = '--no-tags'
+        self._config_done = True
 
     def fetch(self):
         '''Fetch _all_ the remote references into the temp directory `fetch_ref_prefix`.
 
-        Non-fast-forward updates overwrite the local temp references.
+        Non-fast-forward updates overwrite the local temp references. The
+        fetch is never shallow: the local tips are sent as known commits, so
+        the new commits are connected to the history of a shallow clone and
+        fast-forwards are still detected.
+
+        The fetch is skipped when the remote advertises no new references and
+        no reference targets that differ from the local temp references.
+
+        All the references are fetched with a single negotiation and packfile:
+        splitting them into concurrent fetches would only repeat the
+        negotiation. Different repos are fetched in parallel by the caller.
         '''
 
         self._config_local_clone()
         remote = self.cloned_repo.remotes['origin']
+        local_tips = self._local_tips()
+        if all(local_tips.get(name) == oid
+               for name, oid in self._remote_tips(remote).items()):
+            logger.info("Local refs of %r are up to date with 'origin' (%r)",
+                        self.source_repo.full_name, remote.url)
+            return
+
         logger.info("Fetching %r from 'origin' (%r)",
                     self.source_repo.url, remote.url)
-        remote.fetch(callbacks=self.callbacks)
+        remote.fetch(self.expected_refspecs, callbacks=self.callbacks)
+        self._refs_cache = None
+
+    def _remote_tips(self, remote: pygit2.Remote) -> Dict[str, pygit2.Oid]:
+        '''List the targets advertised by `remote`, by their local temp ref name.'''
+
+        tips = {}
+        remote_prefixes = tuple('refs/' + pf for pf in self.fetch_prefix_filters)
+        for head in remote.list_heads(callbacks=self.callbacks):
+            name = head.name
+            if name and name.startswith(remote_prefixes) and not name.endswith('^{}'):
+                tips[name.replace('refs/', self.fetch_ref_prefix, 1)] = head.oid
+        return tips
+
+    def _local_tips(self) -> Dict[str, Union[pygit2.Oid, str]]:
+        prefix = self.fetch_ref_prefix
+        return {name: r.target for name, r in self._refs().items()
+                if name.startswith(prefix)}
+
+    def _refs(self) -> Dict[str, pygit2.Reference]:
+        '''Return all the references of `cloned_repo` by name.
+
+        The references are read once and then kept up to date by the methods
+        that write them. `clone` and `fetch` invalidate the cache.
+        '''
+
+        if self._refs_cache is None:
+            self._refs_cache = {r.name: r
+                                for r in self.cloned_repo.references.iterator()}
+        return self._refs_cache
 
     def _is_remote_ref(self, ref: str):
-        return any(ref.startswith(prefix) for prefix in [self.fetch_ref_prefix])
+        return ref.startswith(self.fetch_ref_prefix)
 
     def update_refs(self, nonff_callback=None):
         '''Update all the local references with the fetched ones.
 
         Non-fast-forward updates cause a the old ref to be backed up with a
         unique suffix. See `_update_one_ref`.
+
+        If any reference changed, the loose references are packed at the end
+        instead of leaving one file per reference.
         '''
 
-        for ref_name in filter(self._is_remote_ref, self.cloned_repo.references):
-            dest_name = ref_name.replace(self.fetch_ref_prefix, 'refs/', 1)
-            self._update_one_ref(ref_name, dest_name, nonff_callback)
+        prefix = self.fetch_ref_prefix
+        refs = self._refs()
+        self._backup_timestr = datetime.now(timezone.utc).strftime('%Y-%m-%d_%H-%M-%S')
+        changed = False
+        for ref_name, ref in list(refs.items()):
+            if not ref_name.startswith(prefix):
+                continue
+            dest_name = ref_name.replace(prefix, 'refs/', 1)
+            changed |= self._update_one_ref(ref, dest_name, refs.get(dest_name),
+                                            nonff_callback)
+
+        if changed:
+            logger.debug("Packing the references of %r", self.dest_path_str)
+            self.cloned_repo.compress_references()
+
+    def _update_one_ref(self, ref: pygit2.Reference, dest_name: str,
+                        dest: Optional[pygit2.Reference],
+                        nonff_callback) -> bool:
+        '''Update the local ref `dest` named `dest_name` with the remote `ref`.
+
+        `dest` is ``None`` when the local ref does not exist yet. Return
+        ``True`` if any reference was written.
+        '''
 
-    def _update_one_ref(self, ref_name: str, dest_name: str, nonff_callback):
-        ref = self.cloned_repo.lookup_reference(ref_name)
-        try:
-            dest = self.cloned_repo.lookup_reference(dest_name)
-        except KeyError:
+        if dest is None:
             logger.debug("Copy remote ref %r to new local ref %r",
                          ref.name, dest_name)
-            self.cloned_repo.create_reference(dest_name, ref.target)
-            return
+            self._refs()[dest_name] = self.cloned_repo.create_reference(
+                dest_name, ref.target)
+            return True
 
         if type(ref.target) == type(dest.target) and ref.target == dest.target:
             logger.debug("Remote ref %r and local ref %r are already equal",
                          ref.name, dest.name)
-            return
+            return False
 
         both_oids = (isinstance(ref.target, pygit2.Oid) and
                      isinstance(dest.target, pygit2.Oid))
@@ -135,9 +232,8 @@ class LocalBackup:
             logger.info("Remote ref %r is a descendant of local ref %r",
                         ref.name, dest.name)
             dest.set_target(ref.target,
-                            'git-backup: Fast-forward {!r} to {!r}'
-                            .format(dest.name, ref.name))
-            return
+                            f"git-backup: Fast-forward '{dest.name}' to '{ref.name}'")
+            return True
 
         dest_backup_name = self._backup_ref_name(dest.name)
         if nonff_callback is None:
@@ -145,24 +241,22 @@ class LocalBackup:
                            ref.name, dest.name)
         elif not nonff_callback(ref, dest, dest_backup_name):
             logger.info('Skip remote ref %r', ref.name)
-            return
+            return False
 
-        self.cloned_repo.create_reference(
+        self._refs()[dest_backup_name] = self.cloned_repo.create_reference(
             dest_backup_name, dest.target, force=False)
         logger.info("Backed up old ref to %r", dest_backup_name)
         dest.set_target(ref.target,
-                        'git-backup: Replace {!r} with remote {!r}, backup old ref as {!r}'
-                        .format(dest.name, ref.name, dest_backup_name))
+                        f"git-backup: Replace '{dest.name}' with remote '{ref.name}', "
+                        f"backup old ref as '{dest_backup_name}'")
+        return True
 
     def _backup_ref_name(self, ref_name: str) -> str:
-        timestr = datetime.now(timezone.utc).strftime('%Y-%m-%d_%H-%M-%S')
-        backup_ref_name = "{}_replaced_{}".format(ref_name, timestr)
+        backup_ref_name = "{}_replaced_{}".format(ref_name, self._backup_timestr)
         alternate_names = (backup_ref_name + '_{:d}'.format(i)
                            for i in itertools.count(1))
         for r in itertools.chain([backup_ref_name], alternate_names):
-            try:
-                self.cloned_repo.lookup_reference(r)
-            except KeyError:
+            if r not in self._refs():
                 return r
         assert False, 'Infinite loop is not infinite'
 
@@ -1,18 +1,38 @@
 import logging
 import logging.config
+import os
 import sys
+from concurrent.futures import Executor, Future, ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import Callable, Optional
 
 import click
+import pygit2
 
 from .backup import LocalBackup
 from .config import load_config, setup_logging
-from .sources import GitSource
+from .sources import GitRepo, GitSource
 
 
 logger = logging.getLogger(__name__)
 
 
+def _clone_and_fetch(repo: GitRepo, subdir: Path,
+                     get_callbacks: Callable[[], pygit2.RemoteCallbacks],
+                     shallow_depth: Optional[int],
+                     update_pool: Executor) -> Future:
+    '''Clone and fetch `repo`, then queue the update of its refs on `update_pool`.
+
+    pygit2 stores per-operation state in the callbacks object, so each repo
+    gets its own instance from `get_callbacks`.
+    '''
+    logger.info("Backing up repo %r", repo.full_name)
+    local_backup = LocalBackup(repo, subdir, get_callbacks(), shallow_depth)
+    local_backup.clone()
+    local_backup.fetch()
+    return update_pool.submit(local_backup.update_refs)
+
+
 @click.command()
 @click.option('-c', '--config', default='config.yml', metavar='PATH',
               help='Path to the configuration file.')
@@ -26,18 +46,45 @@ def main(config, verbose):
     base_dir = Path(cfg['clone_base_dir']).expanduser()
     logger.info('Using %r as base directory for local clones', str(base_dir))
 
+    shallow_depth = cfg['shallow_depth']
+    if shallow_depth is not None:
+        logger.info('Using shallow clones with depth %d', shallow_depth)
+
     sources = {s['name']: GitSource.from_dict(s) for s in cfg['sources']}
 
-    for label, source in sources.items():
-        logger.info("Backing up repos from source %r", label)
-        subdir = base_dir / label
-        callbacks = source.get_callbacks()
-        for repo in source.get_repos():
-            logger.info("Backing up repo %r", repo.full_name)
-            local_backup = LocalBackup(repo, subdir, callbacks)
-            local_backup.clone()
-            local_backup.fetch()
-            local_backup.update_refs()
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as update_pool, \
+            ThreadPoolExecutor(max_workers=cfg['parallel_jobs']) as fetch_pool:
+        fetch_futures = {}
+        for label, source in sources.items():
+            logger.info("Backing up repos from source %r", label)
+            subdir = base_dir / label
+            for repo in source.get_repos():
+                fut = fetch_pool.submit(_clone_and_fetch, repo, subdir,
+                                        source.get_callbacks, shallow_depth,
+                                        update_pool)
+                fetch_futures[fut] = repo
+
+        failures = 0
+        update_futures = {}
+        for fut in as_completed(fetch_futures):
+            try:
+                update_futures[fut.result()] = fetch_futures[fut]
+            except Exception:  # pylint: disable=broad-except
+                failures += 1
+                logger.exception("Clone or fetch of repo %r failed",
+                                 fetch_futures[fut].full_name)
+
+        for fut in as_completed(update_futures):
+            try:
+                fut.result()
+            except Exception:  # pylint: disable=broad-except
+                failures += 1
+                logger.exception("Update of the refs of repo %r failed",
+                                 update_futures[fut].full_name)
+
+    if failures > 0:
+        logger.error("Backup of %d repos failed", failures)
+        click.get_current_context().exit(1)
     return 0
 
 
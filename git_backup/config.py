@@ -1,51 +1,75 @@
+import copy
+import functools
 import logging
 import logging.config
+from importlib.resources import files
 from pathlib import Path
-from typing import Optional
 
-import pkg_resources
 import yaml
 
 
 logger = logging.getLogger(__name__)
 
+# Prefer the libyaml parser when PyYAML was built with it
+_YamlSafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+
 
 def merge_dicts(base: dict, update: dict):
-    for k, v in update.items():
-        if k in base and isinstance(v, dict):
-            merge_dicts(base[k], v)
-        else:
-            base[k] = v
+    '''Recursively merge `update` into `base`, in place.
+
+    A dict value replaces a non-dict value in `base` instead of being merged.
+    '''
+
+    stack = [(base, update)]
+    while stack:
+        base_sub, update_sub = stack.pop()
+        nested = {k for k, v in update_sub.items()
+                  if isinstance(v, dict) and isinstance(base_sub.get(k), dict)}
+        if not nested:
+            base_sub.update(update_sub)
+            continue
+        for k, v in update_sub.items():
+            if k in nested:
+                stack.append((base_sub[k], v))
+            else:
+                base_sub[k] = v
+
+
+_MISSING = object()
 
 
 def get_deep(container, *keys, default=None):
     for k in keys:
-        if k not in container:
+        if type(container) is not dict:  # pylint: disable=unidiomatic-typecheck
+            return default
+        container = container.get(k, _MISSING)
+        if container is _MISSING:
             return default
-        else:
-            container = container[k]
     return container
 
 
 def set_deep(container, *keys, value):
     assert len(keys) > 0, "Cannot set with no keys"
     for k in keys[:-1]:
-        if k not in container:
-            container[k] = {}  # FIXME: What if the next key is `int`?
-        container = container[k]
+        container = container.setdefault(k, {})  # FIXME: What if the next key is `int`?
     container[keys[-1]] = value
 
 
+@functools.lru_cache(maxsize=1)
+def _parse_default_config():
+    raw_yaml = files(__package__).joinpath('data/default_config.yml').read_bytes()
+    return yaml.load(raw_yaml, Loader=_YamlSafeLoader)
+
+
 def read_default_config():
-    raw_yaml = pkg_resources.resource_string(__name__,
-                                             'data/default_config.yml')
-    return yaml.safe_load(raw_yaml)
+    '''Return a new copy of the default configuration, parsed only once.'''
+    return copy.deepcopy(_parse_default_config())
 
 
 def load_config(config_path: str):
     config_exp_path = Path(config_path).expanduser()
     with config_exp_path.open('r') as c:
-        config = yaml.safe_load(c.read())
+        config = yaml.load(c.read(), Loader=_YamlSafeLoader)
     merged_config = read_default_config()
     merge_dicts(merged_config, config)
     return merged_config
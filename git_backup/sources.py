@@ -1,16 +1,64 @@
+import functools
 import logging
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from itertools import starmap
-from typing import Dict, Iterable, Mapping, Optional, Type
+from itertools import count, starmap
+from typing import Callable, Dict, Iterable, Iterator, Mapping, Optional, Sequence, Type
 from urllib.parse import urlparse
 
 import github
 import gitlab
 import pygit2
+from pygit2.enums import CredentialType
 
 logger = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=256)
+def _is_host_url(url: str, host: str) -> bool:
+    '''Check that `url` is an HTTPS URL on `host`.'''
+    if url.startswith('https://' + host + '/'):
+        return True
+    parsed_url = urlparse(url)
+    return parsed_url.scheme == 'https' and parsed_url.netloc == host
+
+
+def _prefetch_pages(get_page: Callable[[int], Sequence], per_page: int,
+                    first_page: int = 0, max_workers: int = 4) -> Iterator:
+    '''Yield the items of `get_page(first_page)`, `get_page(first_page + 1)`, ...
+
+    The first page is fetched alone. Only if it is full, up to `max_workers`
+    following pages are fetched in the background while the items of the
+    previous page are consumed. Stop after the first page with less than
+    `per_page` items.
+
+    `get_page` must be safe to call from multiple threads.
+    '''
+
+    items = get_page(first_page)
+    if len(items) < per_page:
+        yield from items
+        return
+
+    pages = count(first_page + 1)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = deque(executor.submit(get_page, next(pages))
+                        for _ in range(max_workers))
+        try:
+            yield from items
+            while pending:
+                items = pending.popleft().result()
+                if len(items) < per_page:
+                    break
+                pending.append(executor.submit(get_page, next(pages)))
+                yield from items
+        finally:
+            for fut in pending:
+                fut.cancel()
+    yield from items
+
+
 class GitSource(type):
     '''Metaclass used to register and lookup all git source classes.'''
 
@@ -60,7 +108,7 @@ class GitSource(type):
             return C(**args)
 
 
-@dataclass(frozen=True)
+@dataclass(frozen=True, slots=True)
 class GitRepo:
     url: str
     full_name: str
@@ -88,8 +136,8 @@ class PlainGitCallbacks(pygit2.RemoteCallbacks):
         super().__init__()
         self.__key_path = key_path
 
-    def credentials(self, url: str, username_from_url: Optional[str], allowed_types: int):  # pylint: disable=method-hidden
-        if self.__key_path is None or not allowed_types & pygit2.credentials.GIT_CREDTYPE_SSH_KEY:
+    def credentials(self, url: str, username_from_url: Optional[str], allowed_types: CredentialType):  # pylint: disable=method-hidden
+        if self.__key_path is None or not allowed_types & CredentialType.SSH_KEY:
             return super().credentials(url, username_from_url, allowed_types)
 
         return pygit2.Keypair(username_from_url,
@@ -102,8 +150,10 @@ class GithubClient(metaclass=GitSource, tag='github'):
     def __init__(self, token: str):
         self.token = token
         self.client = github.Github(token)
+        self.login = self.client.get_user().login  # Reused by every callback
 
     def get_repos(self) -> Iterable[GitRepo]:
+        # Not prefetched: PyGithub's Requester is not thread-safe
         orig_repos = (self.client.get_user()
                       .get_repos(affiliation='owner,organization_member'))
         return map(lambda r: GitRepo(url=r.clone_url,
@@ -112,7 +162,7 @@ class GithubClient(metaclass=GitSource, tag='github'):
                    orig_repos)
 
     def get_callbacks(self) -> pygit2.RemoteCallbacks:
-        return GithubCallbacks(self.client.get_user().login, self.token)
+        return GithubCallbacks(self.login, self.token)
 
 
 class GithubCallbacks(pygit2.RemoteCallbacks):
@@ -121,12 +171,11 @@ class GithubCallbacks(pygit2.RemoteCallbacks):
         self.__username = username
         self.__token = token
 
-    def credentials(self, url: str, username_from_url: Optional[str], allowed_types: int):  # pylint: disable=method-hidden
-        if not allowed_types & pygit2.credentials.GIT_CREDTYPE_USERPASS_PLAINTEXT:
+    def credentials(self, url: str, username_from_url: Optional[str], allowed_types: CredentialType):  # pylint: disable=method-hidden
+        if not allowed_types & CredentialType.USERPASS_PLAINTEXT:
             return super().credentials(url, username_from_url, allowed_types)
 
-        parsed_url = urlparse(url)
-        if parsed_url.scheme != 'https' or parsed_url.netloc != 'github.com':
+        if not _is_host_url(url, 'github.com'):
             logger.warning('Trying to use Github credentials on a non-github URL: %r',
                            url)
             return super().credentials(url, username_from_url, allowed_types)
@@ -139,15 +188,22 @@ class GitlabClient(metaclass=GitSource, tag='gitlab'):
         self.token = token
         self.client = gitlab.Gitlab('https://gitlab.com', private_token=token)
         self.client.auth()  # Needed to create `user`
+        self.username = self.client.user.username
 
     def get_repos(self) -> Iterable[GitRepo]:
-        projs = self.client.projects.list(all=True, owned=True, simple=True)
+        per_page = 100
+
+        def get_page(page: int):
+            return self.client.projects.list(page=page, per_page=per_page,
+                                             owned=True, simple=True)
+
         return map(lambda p: GitRepo(url=p.http_url_to_repo,
                                      full_name=p.path_with_namespace,
-                                     name=p.path), projs)
+                                     name=p.path),
+                   _prefetch_pages(get_page, per_page, first_page=1))
 
     def get_callbacks(self) -> pygit2.RemoteCallbacks:
-        return GitlabCallbacks(self.client.user.username, self.token)
+        return GitlabCallbacks(self.username, self.token)
 
 
 class GitlabCallbacks(pygit2.RemoteCallbacks):
@@ -156,12 +212,11 @@ class GitlabCallbacks(pygit2.RemoteCallbacks):
         self.__username = username
         self.__token = token
 
-    def credentials(self, url: str, username_from_url: Optional[str], allowed_types: int):  # pylint: disable=method-hidden
-        if not allowed_types & pygit2.credentials.GIT_CREDTYPE_USERPASS_PLAINTEXT:
+    def credentials(self, url: str, username_from_url: Optional[str], allowed_types: CredentialType):  # pylint: disable=method-hidden
+        if not allowed_types & CredentialType.USERPASS_PLAINTEXT:
             return super().credentials(url, username_from_url, allowed_types)
 
-        parsed_url = urlparse(url)
-        if parsed_url.scheme != 'https' or parsed_url.netloc != 'gitlab.com':
+        if not _is_host_url(url, 'gitlab.com'):
             logger.warning('Trying to use Gitlab credentials on a non-gitlab URL: %r',
                            url)
             return super().credentials(url, username_from_url, allowed_types)
@@ -69,7 +69,7 @@ with open('README.md') as readme_file:
 
 requirements = [
     "click",
-    "pygit2",
+    "pygit2>=1.18",  # libgit2 1.9 keeps shallow clones shallow on fetch
     "pygithub",
     "python-gitlab",
     "pyyaml",
@@ -81,6 +81,7 @@ test_requirements = [
     'mypy',
     'pylint',
     'pytest-cov',
+    'pytest-xdist',
     'pytest',
 ]
 
@@ -108,6 +109,7 @@ setup(
     include_package_data=True,
     name='git_backup',
     packages=find_packages(include=['git_backup']),
+    python_requires='>=3.10',
     setup_requires=setup_requirements,
     test_suite='tests',
     tests_require=test_requirements,
@@ -1,7 +1,8 @@
 '''Pytest configuration and common fixtures.'''
 
+import os
 from pathlib import Path
-from shutil import unpack_archive
+from shutil import copy2, copytree, unpack_archive
 
 import pygit2
 import pytest
@@ -28,11 +29,35 @@ def pytest_collection_modifyitems(config, items):  # pylint: disable=missing-doc
                 item.add_marker(skip_slow)
 
 
-@pytest.fixture
-def simple_git_repo(tmp_path):
-    '''A simple git repository with multiple commits, tags and branches.'''
+@pytest.fixture(scope='session')
+def simple_git_repo(tmp_path_factory):
+    '''A simple git repository with multiple commits, tags and branches.
+
+    The repository is shared by all the tests: use `mutable_git_repo` to
+    change it. With pytest-xdist every worker unpacks its own copy in its own
+    base temp directory, so no locking is needed.
+    '''
 
+    tmp_path = tmp_path_factory.mktemp('simple_git_repo')
     tgz_path = TEST_DATA_DIR / 'simple-git-repo.tar.gz'
     unpack_archive(tgz_path, tmp_path)
     repo_path = tmp_path / 'simple-git-repo'
     return pygit2.Repository(str(repo_path))
+
+
+def _link_objects(src, dst):
+    '''Hardlink the immutable git objects, copy everything else.'''
+    if '/.git/objects/' in src:
+        os.link(src, dst)
+    else:
+        copy2(src, dst)
+
+
+@pytest.fixture
+def mutable_git_repo(simple_git_repo, tmp_path):
+    '''A private copy of `simple_git_repo` that a test can change.'''
+
+    repo_path = tmp_path / 'simple-git-repo'
+    copytree(simple_git_repo.workdir, repo_path, symlinks=True,
+             copy_function=_link_objects)
+    return pygit2.Repository(str(repo_path))
@@ -1,7 +1,9 @@
+import subprocess
 import tempfile
+import threading
 from pathlib import Path
-from subprocess import check_call, check_output
 from textwrap import dedent
+from wsgiref.simple_server import WSGIRequestHandler, make_server
 
 import pygit2
 import pytest
@@ -11,6 +13,41 @@ from git_backup.backup import *
 
 pytestmark = pytest.mark.slow
 
+_EDITED_README = dedent('''\
+    # Edited README #
+
+    This file README.md is being replaced to test the fetch of
+    an updated reference.
+''').encode()
+
+
+def _commit_file_change(repo: pygit2.Repository, filename: str, content: bytes,
+                        message: str, amend: bool = False):
+    '''Write `content` to `filename` on master and commit it, or amend the tip.'''
+
+    repo.checkout('refs/heads/master')
+    Path(repo.workdir, filename).write_bytes(content)
+    repo.index.add(filename)
+    repo.index.write()
+    tree = repo.index.write_tree()
+    sig = pygit2.Signature('git-backup tests', 'tests@git-backup.invalid')
+    head = repo.head.peel(pygit2.Commit)
+    if amend:
+        repo.amend_commit(head, 'HEAD', author=sig, committer=sig,
+                          message=message, tree=tree)
+    else:
+        repo.create_commit('HEAD', sig, sig, message, tree, [head.id])
+
+
+@pytest.fixture
+def cloned_bak_repo(simple_git_repo, tmp_path):
+    '''A `LocalBackup` of `simple_git_repo` that is already cloned.'''
+
+    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
+    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
+    bak_repo.clone()
+    return bak_repo
+
 
 def test_smoke(simple_git_repo, tmp_path):
     '''Check that a regular clone-fetch-update cycle runs without crashing.'''
@@ -20,13 +57,11 @@ def test_smoke(simple_git_repo, tmp_path):
     bak_repo.backup()
 
 
-def test_origin_remote(simple_git_repo, tmp_path):
+def test_origin_remote(cloned_bak_repo):
     '''Check that the local backup has an 'origin' remote, with the right URL.'''
 
-    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
-    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
-    bak_repo.clone()
-    assert bak_repo.cloned_repo.remotes['origin'].url == source_repo.url
+    bak_repo = cloned_bak_repo
+    assert bak_repo.cloned_repo.remotes['origin'].url == bak_repo.source_repo.url
 
 
 def test_clone_idempotent(simple_git_repo, tmp_path):
@@ -39,21 +74,19 @@ def test_clone_idempotent(simple_git_repo, tmp_path):
     assert bak_repo.cloned_repo.remotes['origin'].url == source_repo.url
 
 
-def test_fetch_refs(simple_git_repo, tmp_path):
+def test_fetch_refs(cloned_bak_repo):
     '''Check that all the references are fetched with the right name.
 
     See `README.md` for a known issue with non-commit references (like
     `direct_README` in `simple_git_repo`).
     '''
 
-    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
-    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
-    bak_repo.clone()
+    bak_repo = cloned_bak_repo
     bak_repo.fetch()
 
-    backup_refs = [ref for ref in bak_repo.cloned_repo.references
-                   if bak_repo._is_remote_ref(ref)]
-    expected_refs = [
+    backup_refs = set(ref for ref in bak_repo.cloned_repo.references
+                      if bak_repo._is_remote_ref(ref))
+    expected_refs = {
         'refs/git-backup/origin/heads/master',
         'refs/git-backup/origin/heads/fork1',
         'refs/git-backup/origin/heads/fork2',
@@ -61,14 +94,14 @@ def test_fetch_refs(simple_git_repo, tmp_path):
         'refs/git-backup/origin/tags/list_of_refs',
         # 'refs/git-backup/origin/sym_alias_fork1',
         # 'refs/git-backup/origin/direct_README',
-    ]
-    assert sorted(backup_refs) == sorted(expected_refs)
+    }
+    assert backup_refs == expected_refs
 
 
-def test_fetch_fastforward(simple_git_repo, tmp_path):
+def test_fetch_fastforward(mutable_git_repo, tmp_path):
     '''Check that a fast-forwarded remote ref is fetched.'''
 
-    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
+    source_repo = GitRepo(mutable_git_repo.path, 'simple-repo', 'simple-repo')
     bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
     bak_repo.clone()
     bak_repo.fetch()
@@ -77,16 +110,8 @@ def test_fetch_fastforward(simple_git_repo, tmp_path):
         'refs/git-backup/origin/heads/master'
     )
 
-    check_call(['git', 'checkout', 'master'], cwd=simple_git_repo.workdir)
-    with Path(simple_git_repo.workdir).joinpath('README.md').open('w') as f:
-        f.write(dedent('''\
-            # Edited README #
-
-            This file README.md is being replaced to test the fetch of
-            an updated reference.
-        '''))
-    check_call(['git', 'commit', '-am', 'Replace README.md'],
-               cwd=simple_git_repo.workdir)
+    _commit_file_change(mutable_git_repo, 'README.md', _EDITED_README,
+                        'Replace README.md')
 
     bak_repo.fetch()
     new_master = bak_repo.cloned_repo.lookup_reference(
@@ -97,17 +122,15 @@ def test_fetch_fastforward(simple_git_repo, tmp_path):
     )
 
     assert old_master.target != new_master.target
-    assert old_master.target == new_master_parent.oid
-    assert str(new_master.target) == check_output(
-        ['git', 'log', '--pretty=format:%H', '-n', '1', 'master'],
-        cwd=simple_git_repo.workdir, text=True
-    ).strip()
+    assert old_master.target == new_master_parent.id
+    assert new_master.target == \
+        mutable_git_repo.lookup_reference('refs/heads/master').target
 
 
-def test_fetch_nonff(simple_git_repo, tmp_path):
+def test_fetch_nonff(mutable_git_repo, tmp_path):
     '''Check that a non-fast-forwarded remote ref is fetched.'''
 
-    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
+    source_repo = GitRepo(mutable_git_repo.path, 'simple-repo', 'simple-repo')
     bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
     bak_repo.clone()
     bak_repo.fetch()
@@ -116,16 +139,8 @@ def test_fetch_nonff(simple_git_repo, tmp_path):
         'refs/git-backup/origin/heads/master'
     )
 
-    check_call(['git', 'checkout', 'master'], cwd=simple_git_repo.workdir)
-    with Path(simple_git_repo.workdir).joinpath('README.md').open('w') as f:
-        f.write(dedent('''\
-            # Edited README #
-
-            This file README.md is being replaced to test the fetch of
-            an updated reference.
-        '''))
-    check_call(['git', 'commit', '--amend', '-am', 'Replace README.md'],
-               cwd=simple_git_repo.workdir)
+    _commit_file_change(mutable_git_repo, 'README.md', _EDITED_README,
+                        'Replace README.md', amend=True)
 
     bak_repo.fetch()
     new_master = bak_repo.cloned_repo.lookup_reference(
@@ -136,22 +151,18 @@ def test_fetch_nonff(simple_git_repo, tmp_path):
     )
 
     assert old_master.target != new_master.target
-    assert old_master.target != new_master_parent.oid
-    assert str(new_master.target) == check_output(
-        ['git', 'log', '--pretty=format:%H', '-n', '1', 'master'],
-        cwd=simple_git_repo.workdir, text=True
-    ).strip()
+    assert old_master.target != new_master_parent.id
+    assert new_master.target == \
+        mutable_git_repo.lookup_reference('refs/heads/master').target
 
 
-def test_update_idempotent(simple_git_repo, tmp_path):
+def test_update_idempotent(cloned_bak_repo):
     '''Check that a repeated update works.'''
 
-    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
-    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
-    bak_repo.clone()
+    bak_repo = cloned_bak_repo
     bak_repo.fetch()
 
-    expected_refs = [
+    expected_refs = {
         'refs/heads/master',
         'refs/heads/fork1',
         'refs/heads/fork2',
@@ -159,23 +170,23 @@ def test_update_idempotent(simple_git_repo, tmp_path):
         'refs/tags/list_of_refs',
         # 'refs/sym_alias_fork1',
         # 'refs/direct_README',
-    ]
+    }
 
     bak_repo.update_refs()
-    after_one_refs = [ref for ref in bak_repo.cloned_repo.references
-                      if ref.startswith('refs/heads/') or ref.startswith('refs/tags/')]
-    assert sorted(after_one_refs) == sorted(expected_refs)
+    after_one_refs = set(ref for ref in bak_repo.cloned_repo.references
+                         if ref.startswith(('refs/heads/', 'refs/tags/')))
+    assert after_one_refs == expected_refs
 
     bak_repo.update_refs()
-    after_two_refs = [ref for ref in bak_repo.cloned_repo.references
-                      if ref.startswith('refs/heads/') or ref.startswith('refs/tags/')]
-    assert sorted(after_two_refs) == sorted(expected_refs)
+    after_two_refs = set(ref for ref in bak_repo.cloned_repo.references
+                         if ref.startswith(('refs/heads/', 'refs/tags/')))
+    assert after_two_refs == expected_refs
 
 
-def test_update_fastforward(simple_git_repo, tmp_path):
+def test_update_fastforward(mutable_git_repo, tmp_path):
     '''Check that a fast-forwarded ref is updated.'''
 
-    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
+    source_repo = GitRepo(mutable_git_repo.path, 'simple-repo', 'simple-repo')
     bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
     bak_repo.clone()
     bak_repo.fetch()
@@ -183,16 +194,8 @@ def test_update_fastforward(simple_git_repo, tmp_path):
 
     old_master = bak_repo.cloned_repo.lookup_reference('refs/heads/master')
 
-    check_call(['git', 'checkout', 'master'], cwd=simple_git_repo.workdir)
-    with Path(simple_git_repo.workdir).joinpath('README.md').open('w') as f:
-        f.write(dedent('''\
-            # Edited README #
-
-            This file README.md is being replaced to test the fetch of
-            an updated reference.
-        '''))
-    check_call(['git', 'commit', '-am', 'Replace README.md'],
-               cwd=simple_git_repo.workdir)
+    _commit_file_change(mutable_git_repo, 'README.md', _EDITED_README,
+                        'Replace README.md')
 
     bak_repo.fetch()
     bak_repo.update_refs()
@@ -202,17 +205,15 @@ def test_update_fastforward(simple_git_repo, tmp_path):
     )
 
     assert old_master.target != new_master.target
-    assert old_master.target == new_master_parent.oid
-    assert str(new_master.target) == check_output(
-        ['git', 'log', '--pretty=format:%H', '-n', '1', 'master'],
-        cwd=simple_git_repo.workdir, text=True
-    ).strip()
+    assert old_master.target == new_master_parent.id
+    assert new_master.target == \
+        mutable_git_repo.lookup_reference('refs/heads/master').target
 
 
-def test_update_nonff(simple_git_repo, tmp_path):
+def test_update_nonff(mutable_git_repo, tmp_path):
     '''Check that a fast-forwarded ref is updated.'''
 
-    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
+    source_repo = GitRepo(mutable_git_repo.path, 'simple-repo', 'simple-repo')
     bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
     bak_repo.clone()
     bak_repo.fetch()
@@ -220,16 +221,8 @@ def test_update_nonff(simple_git_repo, tmp_path):
 
     old_master = bak_repo.cloned_repo.lookup_reference('refs/heads/master')
 
-    check_call(['git', 'checkout', 'master'], cwd=simple_git_repo.workdir)
-    with Path(simple_git_repo.workdir).joinpath('README.md').open('w') as f:
-        f.write(dedent('''\
-            # Edited README #
-
-            This file README.md is being replaced to test the fetch of
-            an updated reference.
-        '''))
-    check_call(['git', 'commit', '--amend', '-am', 'Replace README.md'],
-               cwd=simple_git_repo.workdir)
+    _commit_file_change(mutable_git_repo, 'README.md', _EDITED_README,
+                        'Replace README.md', amend=True)
 
     nonffcb_args = []
     nonffcb_kwargs = {}
@@ -248,14 +241,157 @@ def test_update_nonff(simple_git_repo, tmp_path):
     )
 
     assert old_master.target != new_master.target
-    assert old_master.target != new_master_parent.oid
-    assert str(new_master.target) == check_output(
-        ['git', 'log', '--pretty=format:%H', '-n', '1', 'master'],
-        cwd=simple_git_repo.workdir, text=True
-    ).strip()
+    assert old_master.target != new_master_parent.id
+    assert new_master.target == \
+        mutable_git_repo.lookup_reference('refs/heads/master').target
 
     assert nonffcb_args[0].target == new_master.target
     assert nonffcb_args[1].target == new_master.target  # After update
     assert bak_repo.cloned_repo.lookup_reference(nonffcb_args[2]).target == \
         old_master.target
     assert nonffcb_args[2].startswith('refs/heads/master_replaced_')
+
+
+@pytest.fixture
+def http_git_url(mutable_git_repo):
+    '''A smart HTTP URL of `mutable_git_repo`, served by ``git http-backend``.
+
+    The local transport does not support shallow fetches, so the shallow
+    clones need a network remote.
+    '''
+
+    project_root = Path(mutable_git_repo.workdir).parent
+
+    def app(environ, start_response):
+        body = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        env = {k: v for k, v in environ.items() if isinstance(v, str)}
+        env.update(GIT_PROJECT_ROOT=str(project_root), GIT_HTTP_EXPORT_ALL='1')
+        output = subprocess.run(['git', 'http-backend'], input=body, env=env,
+                                stdout=subprocess.PIPE, check=True).stdout
+        head, _, content = output.partition(b'\r\n\r\n')
+        headers = [tuple(line.split(': ', 1))
+                   for line in head.decode().split('\r\n')]
+        status = dict(headers).get('Status', '200 OK')
+        start_response(status, [h for h in headers if h[0] != 'Status'])
+        return [content]
+
+    class QuietHandler(WSGIRequestHandler):
+        def log_message(self, *args):  # pylint: disable=arguments-differ
+            pass
+
+    server = make_server('127.0.0.1', 0, app, handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://127.0.0.1:{:d}/{}'.format(server.server_port,
+                                           Path(mutable_git_repo.workdir).name)
+    server.shutdown()
+    thread.join()
+    server.server_close()
+
+
+@pytest.mark.parametrize('new_commits', [1, 3])
+def test_shallow_fastforward(mutable_git_repo, http_git_url, tmp_path, new_commits):
+    '''Check that a shallow clone is updated by fast-forward and stays shallow.'''
+
+    source_repo = GitRepo(http_git_url, 'simple-repo', 'simple-repo')
+    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups',
+                           shallow_depth=1)
+    bak_repo.backup()
+    assert bak_repo.cloned_repo.is_shallow
+    old_master = bak_repo.cloned_repo.lookup_reference('refs/heads/master').target
+    old_history = list(bak_repo.cloned_repo.walk(old_master))
+    assert len(old_history) == 1
+
+    for i in range(new_commits):
+        _commit_file_change(mutable_git_repo, 'README.md',
+                            _EDITED_README + str(i).encode(),
+                            'Edit README.md ({:d})'.format(i))
+
+    # A later run
+    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups',
+                           shallow_depth=1)
+    bak_repo.backup()
+
+    cloned_repo = bak_repo.cloned_repo
+    new_master = cloned_repo.lookup_reference('refs/heads/master').target
+    assert new_master == mutable_git_repo.lookup_reference('refs/heads/master').target
+    assert not [r for r in cloned_repo.references if '_replaced_' in r]
+    assert cloned_repo.is_shallow
+    assert [c.id for c in cloned_repo.walk(new_master)][new_commits:] == \
+        [c.id for c in old_history]
+
+
+def test_shallow_local_path(simple_git_repo, tmp_path):
+    '''Check that a repo at a local path is cloned in full even if shallow.'''
+
+    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
+    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups',
+                           shallow_depth=1)
+    bak_repo.backup()
+    assert not bak_repo.cloned_repo.is_shallow
+
+
+def test_update_packs_refs(simple_git_repo, tmp_path):
+    '''Check that updated references are packed instead of left loose.'''
+
+    source_repo = GitRepo(simple_git_repo.path, 'simple-repo', 'simple-repo')
+    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
+    bak_repo.backup()
+
+    loose_refs = [p for d in ['heads', 'tags', 'git-backup']
+                  for p in (bak_repo.dest_path / 'refs' / d).rglob('*')
+                  if p.is_file()]
+    assert loose_refs == []
+    assert 'refs/heads/master' in bak_repo.cloned_repo.references
+
+
+@pytest.mark.parametrize('new_instance', [False, True])
+def test_fetch_skip_unchanged(cloned_bak_repo, monkeypatch, new_instance):
+    '''Check that nothing is fetched when the remote refs are unchanged.
+
+    With `new_instance` the second fetch is done by a new `LocalBackup` of the
+    existing clone, like a later run.
+    '''
+
+    bak_repo = cloned_bak_repo
+    bak_repo.fetch()
+    if new_instance:
+        bak_repo = LocalBackup(bak_repo.source_repo, bak_repo.dest_path.parent)
+        bak_repo.clone()
+
+    def fail_fetch(*args, **kwargs):
+        raise AssertionError('Remote.fetch should not be called')
+
+    monkeypatch.setattr(pygit2.Remote, 'fetch', fail_fetch)
+    bak_repo.fetch()
+
+
+def test_clone_checks_origin(cloned_bak_repo, tmp_path):
+    '''Check that an existing clone without the right 'origin' is rejected.'''
+
+    bak_repo = cloned_bak_repo
+
+    bak_repo.cloned_repo.remotes.set_url('origin', str(tmp_path / 'other'))
+    with pytest.raises(RuntimeError, match='has URL'):
+        LocalBackup(bak_repo.source_repo, tmp_path / 'local_backups').clone()
+
+    bak_repo.cloned_repo.remotes.delete('origin')
+    with pytest.raises(RuntimeError, match="does not have an 'origin' remote"):
+        LocalBackup(bak_repo.source_repo, tmp_path / 'local_backups').clone()
+
+
+def test_refs_cache(mutable_git_repo, tmp_path):
+    '''Check that the cached references match the repo after an update.'''
+
+    source_repo = GitRepo(mutable_git_repo.path, 'simple-repo', 'simple-repo')
+    bak_repo = LocalBackup(source_repo, tmp_path / 'local_backups')
+    bak_repo.backup()
+
+    _commit_file_change(mutable_git_repo, 'README.md', _EDITED_README,
+                        'Amended', amend=True)
+    bak_repo.backup()
+
+    cached = {name: ref.target for name, ref in bak_repo._refs().items()}
+    actual = {ref.name: ref.target
+              for ref in bak_repo.cloned_repo.references.iterator()}
+    assert cached == actual
@@ -0,0 +1,53 @@
+from textwrap import dedent
+
+import pygit2
+import pytest
+from click.testing import CliRunner
+
+from git_backup.cli import main
+
+
+pytestmark = pytest.mark.slow
+
+
+def _write_config(tmp_path, repos):
+    repo_lines = ''.join('        {}: {}\n'.format(name, path)
+                         for name, path in repos.items())
+    config_path = tmp_path / 'config.yml'
+    config_path.write_text(dedent('''\
+        clone_base_dir: {}
+        parallel_jobs: 2
+        sources:
+          - name: local
+            plain_git:
+              repos:
+        ''').format(tmp_path / 'local_backups') + repo_lines)
+    return config_path
+
+
+def test_main_backs_up_all_repos(simple_git_repo, tmp_path):
+    '''Check that every repo of every source is backed up.'''
+
+    config_path = _write_config(tmp_path, {'one': simple_git_repo.path,
+                                           'two': simple_git_repo.path})
+    result = CliRunner().invoke(main, ['-c', str(config_path)])
+
+    assert result.exit_code == 0
+    for name in ['one', 'two']:
+        bak_repo = pygit2.Repository(str(tmp_path / 'local_backups' / 'local' /
+                                         (name + '.git')))
+        assert 'refs/heads/master' in bak_repo.references
+
+
+def test_main_exit_code_on_failure(simple_git_repo, tmp_path):
+    '''Check that a failing repo does not stop the others, but fails the run.'''
+
+    config_path = _write_config(tmp_path, {'good': simple_git_repo.path,
+                                           'bad': tmp_path / 'missing'})
+    result = CliRunner().invoke(main, ['-c', str(config_path)])
+
+    assert isinstance(result.exception, SystemExit)
+    assert result.exit_code == 1
+    bak_repo = pygit2.Repository(str(tmp_path / 'local_backups' / 'local' /
+                                     'good.git'))
+    assert 'refs/heads/master' in bak_repo.references
@@ -10,6 +10,9 @@ from git_backup import config
      {'a': {'three': 3}}, {'a': {'one': 1, 'two': 2, 'three': 3}, 'b': {'four': 4}}),
     ({}, {}, {}),
     ({}, {'a': {'one': 1, 'two': 2}}, {'a': {'one': 1, 'two': 2}}),
+    ({'a': 1}, {'a': {'one': 1}}, {'a': {'one': 1}}),
+    ({'a': {'b': {'c': {'one': 1}}}}, {'a': {'b': {'c': {'two': 2}}}},
+     {'a': {'b': {'c': {'one': 1, 'two': 2}}}}),
 ])
 def test_merge_dict(base, update, expected):
     config.merge_dicts(base, update)
@@ -20,12 +23,21 @@ def test_merge_dict(base, update, expected):
     ({'x': 1, 'y': 2}, ['x'], 1),
     ({'x': {'xx': 1}, 'y': 2}, ['x', 'xx'], 1),
     ({'x': {'xx': 1}, 'y': 2}, ['x', 'xy', 'y'], None),
+    ({'x': {'xx': 1}, 'y': 2}, ['y', 'yy'], None),
+    ({'x': {'xx': None}}, ['x', 'xx'], None),
+    ({'x': 1}, [], {'x': 1}),
 ])
 def test_get_deep(container, keys, expected):
     value = config.get_deep(container, *keys)
     assert value == expected
 
 
+def test_get_deep_default():
+    assert config.get_deep({'x': {'xx': None}}, 'x', 'xx', default=0) is None
+    assert config.get_deep({'x': {'xx': 1}}, 'x', 'xy', default=0) == 0
+    assert config.get_deep({'x': 1}, 'x', 'xx', default=0) == 0
+
+
 @pytest.mark.parametrize('container, keys, value, expected', [
     ({'x': 1, 'y': 2}, ['x'], -1,
      {'x': -1, 'y': 2}),
@@ -37,3 +49,9 @@ def test_get_deep(container, keys, expected):
 def test_set_deep(container, keys, value, expected):
     config.set_deep(container, *keys, value=value)
     assert container == expected
+
+
+def test_read_default_config_copy():
+    default = config.read_default_config()
+    default['logging']['version'] = -1
+    assert config.read_default_config()['logging']['version'] == 1
@@ -0,0 +1,75 @@
+import copy
+import pickle
+
+import pygit2
+import pytest
+from pygit2.enums import CredentialType
+
+from git_backup import sources
+
+
+@pytest.mark.parametrize('url, host, expected', [
+    ('https://github.com/riccz/git-backup.git', 'github.com', True),
+    ('https://github.com', 'github.com', True),
+    ('http://github.com/riccz/git-backup.git', 'github.com', False),
+    ('https://gitlab.com/riccz/git-backup.git', 'github.com', False),
+    ('https://github.com.example.org/x.git', 'github.com', False),
+    ('git@github.com:riccz/git-backup.git', 'github.com', False),
+])
+def test_is_host_url(url, host, expected):
+    assert sources._is_host_url(url, host) == expected
+
+
+@pytest.mark.parametrize('callbacks, url, allowed_types, expected', [
+    (sources.PlainGitCallbacks('/keys/id_ed25519'), 'ssh://example.org/x.git',
+     CredentialType.SSH_KEY, pygit2.Keypair),
+    (sources.GithubCallbacks('user', 'token'), 'https://github.com/x.git',
+     CredentialType.USERPASS_PLAINTEXT, pygit2.UserPass),
+    (sources.GitlabCallbacks('user', 'token'), 'https://gitlab.com/x.git',
+     CredentialType.USERPASS_PLAINTEXT, pygit2.UserPass),
+])
+def test_callbacks_credentials(callbacks, url, allowed_types, expected):
+    assert isinstance(callbacks.credentials(url, 'git', allowed_types), expected)
+
+
+@pytest.mark.parametrize('first_page, num_items', [
+    (0, 0),
+    (0, 1),
+    (0, 2),
+    (1, 5),
+    (0, 20),
+])
+def test_prefetch_pages(first_page, num_items):
+    items = list(range(num_items))
+    requested = []
+
+    def get_page(page):
+        requested.append(page)
+        start = (page - first_page) * 2
+        return items[start:start + 2]
+
+    assert list(sources._prefetch_pages(get_page, 2, first_page=first_page)) == items
+    assert first_page in requested
+
+
+@pytest.mark.parametrize('num_items', [0, 1])
+def test_prefetch_pages_single_page(num_items):
+    requested = []
+
+    def get_page(page):
+        requested.append(page)
+        return list(range(num_items)) if page == 0 else []
+
+    assert list(sources._prefetch_pages(get_page, 2)) == list(range(num_items))
+    assert requested == [0]
+
+
+def test_git_repo_slots():
+    repo = sources.GitRepo('https://example.org/a.git', 'group/a', 'a')
+    assert not hasattr(repo, '__dict__')
+    assert repo == sources.GitRepo('https://example.org/a.git', 'group/a', 'a')
+    with pytest.raises(AttributeError):
+        repo.name = 'b'
+    assert copy.copy(repo) == repo
+    assert copy.deepcopy(repo) == repo
+    assert pickle.loads(pickle.dumps(repo)) == repo